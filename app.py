@@ -1,14 +1,52 @@
 # app.py
 import streamlit as st
-from PyPDF2 import PdfReader
-import tempfile
+import fitz
 import os
+import tempfile
+from pathlib import Path
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.embeddings import HuggingFaceEmbeddings
+from langchain.embeddings.base import Embeddings
 from langchain.vectorstores import FAISS
+from langchain.docstore import InMemoryDocstore
+from langchain.schema import Document
 from langchain.llms import Ollama
 from langchain.chains import RetrievalQA
+from langchain.prompts import PromptTemplate
+from langchain.cache import SQLiteCache
+from langchain.globals import set_llm_cache
 import base64
+import hashlib
+from pdf_text import extract_pages
+import faiss
+import numpy as np
+import orjson
+import zstandard
+import torch
+from sentence_transformers import SentenceTransformer
+from transformers import AutoTokenizer
+from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTOptimizer, ORTQuantizer
+from optimum.onnxruntime.configuration import AutoQuantizationConfig, OptimizationConfig
+
+EMBED_MODEL_ID = "sentence-transformers/all-MiniLM-L6-v2"
+EMBED_MODEL_DIR = "./minilm-onnx"
+EMBED_MAX_LENGTH = 256
+RAG_CACHE_DIR = Path(".rag_cache")
+SEMANTIC_CACHE_THRESHOLD = 0.95
+MAX_CACHED_BOOKS = 4
+
+# Static instructions first, then retrieved context, then the question: the
+# prefix must stay byte-identical across calls for Ollama's prompt cache to hit.
+QA_PROMPT = PromptTemplate(
+    input_variables=["context", "question"],
+    template=(
+        "You are a helpful assistant answering questions about a book. "
+        "Use only the excerpts below to answer. If the answer is not in the "
+        "excerpts, say that you don't know; do not make one up.\n\n"
+        "Excerpts:\n{context}\n\n"
+        "Question: {question}\n"
+        "Answer:"
+    ),
+)
 
 # -------------------------------
 # Page Config
@@ -16,9 +54,224 @@ import base64
 st.set_page_config(page_title="My Book QA", page_icon="📚", layout="wide")
 st.title("📚 Upload, Read & Ask Questions from Your Book")
 
+# -------------------------------
+# Helpers
+# -------------------------------
+def atomic_write(path, write):
+    """Call write(tmp_path) on a temp file beside path, then rename it onto path.
+
+    A process killed mid-write leaves only the temp file behind, never a
+    truncated file at path.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+    os.close(fd)
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+class OnnxMiniLMEmbeddings(Embeddings):
+    """all-MiniLM-L6-v2 on ONNX Runtime, graph-optimized and INT8-quantized, embedded in large batches."""
+
+    backend = "minilm-onnx-int8"
+
+    def __init__(self, model_dir=EMBED_MODEL_DIR, batch_size=128):
+        quantized = "model_optimized_quantized.onnx"
+        # The quantized model is written last, so its presence marks a complete build
+        if not os.path.exists(os.path.join(model_dir, quantized)):
+            AutoTokenizer.from_pretrained(EMBED_MODEL_ID).save_pretrained(model_dir)
+            model = ORTModelForFeatureExtraction.from_pretrained(EMBED_MODEL_ID, export=True)
+            ORTOptimizer.from_pretrained(model).optimize(
+                save_dir=model_dir,
+                optimization_config=OptimizationConfig(optimization_level=99),
+            )
+            ORTQuantizer.from_pretrained(model_dir, file_name="model_optimized.onnx").quantize(
+                save_dir=model_dir,
+                quantization_config=AutoQuantizationConfig.avx2(is_static=False, per_channel=False),
+            )
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.model = ORTModelForFeatureExtraction.from_pretrained(model_dir, file_name=quantized)
+        self.batch_size = batch_size
+
+    def _encode(self, texts):
+        inputs = self.tokenizer(texts, padding=True, truncation=True, max_length=EMBED_MAX_LENGTH, return_tensors="np")
+        hidden = self.model(**inputs).last_hidden_state
+        # Mean pooling + L2 normalisation, matching the sentence-transformers pipeline
+        mask = inputs["attention_mask"][..., None].astype(hidden.dtype)
+        vecs = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        vecs /= np.clip(np.linalg.norm(vecs, axis=1, keepdims=True), 1e-12, None)
+        return vecs.tolist()
+
+    def embed_documents(self, texts):
+        out = []
+        for i in range(0, len(texts), self.batch_size):
+            out.extend(self._encode(texts[i:i + self.batch_size]))
+        return out
+
+    def embed_query(self, text):
+        return self._encode([text])[0]
+
+class CudaMiniLMEmbeddings(Embeddings):
+    """all-MiniLM-L6-v2 on the GPU in FP16 via sentence-transformers."""
+
+    backend = "minilm-cuda-fp16"
+
+    def __init__(self, batch_size=256):
+        self.model = SentenceTransformer(EMBED_MODEL_ID, device="cuda")
+        self.model.half()
+        self.batch_size = batch_size
+
+    def _encode(self, texts):
+        return self.model.encode(
+            texts,
+            batch_size=self.batch_size,
+            convert_to_numpy=True,
+            normalize_embeddings=True,
+            show_progress_bar=False,
+        ).astype("float32").tolist()
+
+    def embed_documents(self, texts):
+        return self._encode(texts)
+
+    def embed_query(self, text):
+        return self._encode([text])[0]
+
+def get_page_texts(pdf_hash, pdf_bytes, num_pages):
+    text_path = RAG_CACHE_DIR / pdf_hash / "pages.json.zst"
+    if text_path.exists():
+        return orjson.loads(zstandard.ZstdDecompressor().decompress(text_path.read_bytes()))
+    pages = extract_pages(pdf_bytes, num_pages)
+    text_path.parent.mkdir(parents=True, exist_ok=True)
+    pages_data = zstandard.ZstdCompressor(level=3).compress(orjson.dumps(pages))
+    atomic_write(text_path, lambda tmp_path: Path(tmp_path).write_bytes(pages_data))
+    return pages
+
+@st.cache_resource(show_spinner=False)
+def init_llm_cache():
+    """Exact-match cache for LLM calls, shared across sessions and restarts; set up once per process."""
+    set_llm_cache(SQLiteCache(database_path=".llm_cache.db"))
+
+@st.cache_resource(show_spinner=False)
+def get_llm():
+    """Llama 3 via Ollama, or via llama.cpp when GYAN_GGUF_PATH points at a GGUF model.
+
+    The llama.cpp path drafts tokens by n-gram lookup in the prompt (which holds the
+    retrieved chunks) and verifies them in one pass, speeding up extractive answers.
+    """
+    gguf_path = os.environ.get("GYAN_GGUF_PATH")
+    if gguf_path:
+        from langchain.llms import LlamaCpp
+        from llama_cpp.llama_speculative import LlamaPromptLookupDecoding
+
+        return LlamaCpp(
+            model_path=gguf_path,
+            temperature=0.2,
+            n_ctx=8192,
+            max_tokens=512,
+            model_kwargs={"draft_model": LlamaPromptLookupDecoding(max_ngram_size=3, num_pred_tokens=10)},
+        )
+    # keep_alive keeps the model, and with it the prompt KV cache, loaded between questions
+    return Ollama(model="llama3", temperature=0.2, num_ctx=8192, keep_alive="30m")
+
+@st.cache_resource(show_spinner=False)
+def get_tokenizer():
+    return AutoTokenizer.from_pretrained(EMBED_MODEL_ID)
+
+def get_chunks(pages):
+    # Sized in MiniLM tokens so chunks fit the embedder's window without truncation;
+    # the splitter does not count [CLS]/[SEP], so leave room for them
+    tokenizer = get_tokenizer()
+    splitter = RecursiveCharacterTextSplitter.from_huggingface_tokenizer(
+        tokenizer, chunk_size=EMBED_MAX_LENGTH - tokenizer.num_special_tokens_to_add(), chunk_overlap=32
+    )
+    # Split page by page; the whole book is never joined into one string
+    docs = [Document(page_content=text, metadata={"page": i + 1}) for i, text in enumerate(pages) if text]
+    return splitter.split_documents(docs)
+
+@st.cache_resource(show_spinner=False)
+def get_embedder():
+    if torch.cuda.is_available():
+        return CudaMiniLMEmbeddings()
+    return OnnxMiniLMEmbeddings()
+
+# Cached across reruns and bounded, since each entry holds a whole book's index.
+# The leading underscore keeps Streamlit from hashing the PDF bytes, so entries
+# are keyed on the upload's pdf_hash.
+@st.cache_resource(show_spinner=False, max_entries=MAX_CACHED_BOOKS)
+def build_vectorstore(pdf_hash, _pdf_bytes, num_pages):
+    """HNSW instead of FAISS.from_texts' flat index: no training, sublinear queries.
+
+    The index (FAISS binary format) and chunks (zstd-compressed JSON) are persisted
+    under .rag_cache/<pdf_hash>/<embedder backend>, so re-uploading the same book
+    skips extraction, chunking and embedding entirely. Keying on the backend keeps
+    an index built by one embedder from being queried with vectors from another.
+    Returns None when the PDF has no extractable text.
+    """
+    embeddings = get_embedder()
+    cache_dir = RAG_CACHE_DIR / pdf_hash / embeddings.backend
+    index_path = cache_dir / "index.faiss"
+    chunks_path = cache_dir / "chunks.json.zst"
+    if index_path.exists() and chunks_path.exists():
+        index = faiss.read_index(str(index_path))
+        chunks = [
+            Document(page_content=c["text"], metadata=c["metadata"])
+            for c in orjson.loads(zstandard.ZstdDecompressor().decompress(chunks_path.read_bytes()))
+        ]
+    else:
+        pages = get_page_texts(pdf_hash, _pdf_bytes, num_pages)
+        if not any(text.strip() for text in pages):
+            return None
+        chunks = get_chunks(pages)
+        vecs = np.asarray(embeddings.embed_documents([c.page_content for c in chunks]), dtype="float32")
+        index = faiss.index_factory(vecs.shape[1], "HNSW32")
+        index.hnsw.efConstruction = 200
+        index.add(vecs)
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        chunks_data = zstandard.ZstdCompressor(level=3).compress(
+            orjson.dumps([{"text": c.page_content, "metadata": c.metadata} for c in chunks])
+        )
+        atomic_write(chunks_path, lambda tmp_path: Path(tmp_path).write_bytes(chunks_data))
+        # Written last: its presence marks a complete cache entry
+        atomic_write(index_path, lambda tmp_path: faiss.write_index(index, tmp_path))
+    index.hnsw.efSearch = 32
+    return FAISS(
+        embedding_function=embeddings,
+        index=index,
+        docstore=InMemoryDocstore({
+            str(i): Document(page_content=c.page_content, metadata={**c.metadata, "id": i})
+            for i, c in enumerate(chunks)
+        }),
+        index_to_docstore_id={i: str(i) for i in range(len(chunks))},
+    )
+
+def lookup_cached_answer(query_vec):
+    """Return the cached result of the nearest past question, if it is close enough."""
+    cache = st.session_state.query_cache
+    if cache is None or cache["index"].ntotal == 0:
+        return None
+    scores, ids = cache["index"].search(np.asarray([query_vec], dtype="float32"), 1)
+    if scores[0][0] > SEMANTIC_CACHE_THRESHOLD:
+        return cache["results"][ids[0][0]]
+    return None
+
+def store_cached_answer(query_vec, result):
+    if st.session_state.query_cache is None:
+        # Embeddings are L2-normalised, so inner product is cosine similarity
+        st.session_state.query_cache = {"index": faiss.IndexFlatIP(len(query_vec)), "results": []}
+    cache = st.session_state.query_cache
+    cache["index"].add(np.asarray([query_vec], dtype="float32"))
+    cache["results"].append(result)
+
+init_llm_cache()
+
 # -------------------------------
 # Session State Init
 # -------------------------------
+if "query_cache" not in st.session_state:
+    st.session_state.query_cache = None
 if "vectorstore" not in st.session_state:
     st.session_state.vectorstore = None
 if "qa_chain" not in st.session_state:
@@ -32,10 +285,12 @@ if "pdf_processed" not in st.session_state:
 uploaded_file = st.file_uploader("Upload your book (PDF)", type="pdf")
 
 if uploaded_file:
-    # Save temp file
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as f:
-        f.write(uploaded_file.getvalue())
-        temp_path = f.name
+    pdf_bytes = uploaded_file.getvalue()
+    pdf_hash = hashlib.blake2b(pdf_bytes, digest_size=16).hexdigest()
+    if st.session_state.get("pdf_hash") != pdf_hash:
+        st.session_state.pdf_display = None
+        st.session_state.pdf_hash = pdf_hash
+        st.session_state.query_cache = None
 
     # -------------------------------
     # PDF Viewer
@@ -43,52 +298,42 @@ if uploaded_file:
     col1, col2 = st.columns([1, 1])
     with col1:
         st.subheader("📖 PDF Preview")
-        with open(temp_path, "rb") as pdf_file:
-            base64_pdf = base64.b64encode(pdf_file.read()).decode('utf-8')
-        pdf_display = f'<iframe src="data:application/pdf;base64,{base64_pdf}" width="100%" height="600" type="application/pdf"></iframe>'
-        st.markdown(pdf_display, unsafe_allow_html=True)
+        # Opt-in: the base64 payload is ~4/3 of the file size, so large books skip it by default
+        if st.checkbox("Show PDF preview", value=False):
+            if st.session_state.pdf_display is None:
+                # Encode once per upload and keep the finished markup, not on every rerun
+                base64_pdf = base64.b64encode(pdf_bytes).decode("ascii")
+                st.session_state.pdf_display = f'<iframe src="data:application/pdf;base64,{base64_pdf}" width="100%" height="600" type="application/pdf"></iframe>'
+            st.markdown(st.session_state.pdf_display, unsafe_allow_html=True)
 
     # -------------------------------
     # Extract Text + Build RAG
     # -------------------------------
     with col2:
         st.subheader("🔄 Processing Book...")
-        reader = PdfReader(temp_path)
-        num_pages = len(reader.pages)
+        with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+            num_pages = doc.page_count
         st.write(f"Pages: **{num_pages}**")
 
-        # Extract full text
-        with st.spinner("Extracting text..."):
-            raw_text = ""
-            for i, page in enumerate(reader.pages):
-                text = page.extract_text()
-                if text:
-                    raw_text += text
+        # Extract text + split into chunks + create embeddings + vector DB
+        with st.spinner("Building knowledge base..."):
+            vectorstore = build_vectorstore(pdf_hash, pdf_bytes, num_pages)
 
-        if not raw_text.strip():
+        if vectorstore is None:
             st.error("No text found. Is this a scanned PDF? Use OCR version.")
             st.stop()
-
-        # Split into chunks
-        with st.spinner("Splitting into chunks..."):
-            splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-            chunks = splitter.split_text(raw_text)
-
-        # Create embeddings + vector DB
-        with st.spinner("Building knowledge base..."):
-            embeddings = HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2")
-            vectorstore = FAISS.from_texts(chunks, embeddings)
-            st.session_state.vectorstore = vectorstore
+        st.session_state.vectorstore = vectorstore
 
         # Setup LLM + QA Chain
         with st.spinner("Loading LLM (Llama 3)..."):
-            llm = Ollama(model="llama3", temperature=0.2)
+            llm = get_llm()
             retriever = vectorstore.as_retriever(search_kwargs={"k": 4})
             qa_chain = RetrievalQA.from_chain_type(
                 llm=llm,
                 chain_type="stuff",
                 retriever=retriever,
-                return_source_documents=True
+                return_source_documents=True,
+                chain_type_kwargs={"prompt": QA_PROMPT}
             )
             st.session_state.qa_chain = qa_chain
             st.session_state.pdf_processed = True
@@ -105,22 +350,29 @@ if uploaded_file:
 
         if question:
             with st.spinner("Thinking..."):
-                result = st.session_state.qa_chain({"query": question})
+                query_vec = get_embedder().embed_query(question)
+                result = lookup_cached_answer(query_vec)
+                if result is None:
+                    output = st.session_state.qa_chain({"query": question})
+                    # Keep only chunk ids; the text is looked up in the docstore when shown
+                    result = {
+                        "result": output["result"],
+                        "source_ids": [doc.metadata["id"] for doc in output["source_documents"]],
+                    }
+                    store_cached_answer(query_vec, result)
                 answer = result["result"]
-                sources = result["source_documents"]
+                source_ids = result["source_ids"]
 
             st.markdown("### 📝 Answer")
             st.write(answer)
 
-            with st.expander("🔍 View Sources"):
-                for i, doc in enumerate(sources):
-                    st.markdown(f"**Source {i+1}:**")
+            # A checkbox rather than an expander: expander contents are sent even when collapsed
+            if st.checkbox("🔍 View Sources", value=False):
+                for i, sid in enumerate(source_ids):
+                    doc = st.session_state.vectorstore.docstore.search(str(sid))
+                    st.markdown(f"**Source {i+1}** (page {doc.metadata.get('page', '?')}):")
                     st.code(doc.page_content[:500] + ("..." if len(doc.page_content) > 500 else ""), language=None)
 
-    # Cleanup
-    if os.path.exists(temp_path):
-        os.unlink(temp_path)
-
 else:
     st.info("👆 Upload a PDF to start reading and asking!")
     st.markdown("""
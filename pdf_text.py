@@ -0,0 +1,48 @@
+# pdf_text.py
+# Kept out of app.py so the worker is importable (picklable) from child processes.
+import multiprocessing
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import fitz
+
+# Below this many pages, starting worker processes costs more than it saves
+MIN_PAGES_FOR_POOL = 32
+
+
+def _extract_range(path, start, stop):
+    with fitz.open(path) as doc:
+        return [doc.load_page(i).get_text("text") for i in range(start, stop)]
+
+
+def extract_pages(pdf_bytes, num_pages):
+    """Extract the text of every page, in page order.
+
+    PyMuPDF does not support Python threads, so larger books follow its
+    multiprocessing recipe: the PDF is written once to a temp file and each
+    worker process opens it by path and handles one contiguous range of pages.
+    Workers only receive the path, so the upload is never copied per task.
+    """
+    if num_pages < MIN_PAGES_FOR_POOL:
+        with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+            return [doc.load_page(i).get_text("text") for i in range(num_pages)]
+
+    workers = min(os.cpu_count() or 1, num_pages)
+    step = -(-num_pages // workers)
+    ranges = [(start, min(start + step, num_pages)) for start in range(0, num_pages, step)]
+    with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as f:
+        f.write(pdf_bytes)
+        path = f.name
+    try:
+        pages = []
+        # spawn, not fork: Streamlit and the embedder's thread pools are already
+        # running here, and forking a multi-threaded process can deadlock
+        ctx = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=len(ranges), mp_context=ctx) as ex:
+            futures = [ex.submit(_extract_range, path, start, stop) for start, stop in ranges]
+            for future in futures:
+                pages.extend(future.result())
+        return pages
+    finally:
+        os.unlink(path)